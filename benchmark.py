@@ -0,0 +1,238 @@
+import argparse
+import copy
+import hashlib
+import json
+import os
+import random
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+from urllib.parse import parse_qs, urlparse
+import numpy as np
+from requests.adapters import BaseAdapter
+from requests.models import Response
+from requests.structures import CaseInsensitiveDict
+from playlistBuilder import MODEL_FIELDS, Metric, PlaylistBuilder, RateLimiter, TokenManager, Track, TrackInfo, selectSeeds
+
+# Recorded response objects, replayed with the id and names swapped per request
+RECORDED_TRACK = {
+    "album": {
+        "album_type": "album",
+        "artists": [{"external_urls": {"spotify": "https://open.spotify.com/artist/0"}, "href": "https://api.spotify.com/v1/artists/0", "id": "0", "name": "Artist", "type": "artist", "uri": "spotify:artist:0"}],
+        "available_markets": ["AD", "AE", "AG", "AL", "AM", "AO", "AR", "AT", "AU", "AZ", "BA", "BB", "BD", "BE", "BF", "BG", "BH", "BI", "BJ", "BN", "BO", "BR", "BS", "BT", "BW", "BY", "BZ", "CA", "CD", "CG", "CH", "CI", "CL", "CM", "CO", "CR", "CV", "CW", "CY", "CZ", "DE", "DJ", "DK", "DM", "DO", "DZ", "EC", "EE", "EG", "ES", "US"],
+        "external_urls": {"spotify": "https://open.spotify.com/album/0"},
+        "href": "https://api.spotify.com/v1/albums/0",
+        "id": "0",
+        "images": [{"height": 640, "url": "https://i.scdn.co/image/0", "width": 640}, {"height": 300, "url": "https://i.scdn.co/image/1", "width": 300}, {"height": 64, "url": "https://i.scdn.co/image/2", "width": 64}],
+        "name": "Album",
+        "release_date": "1975-01-01",
+        "release_date_precision": "day",
+        "total_tracks": 12,
+        "type": "album",
+        "uri": "spotify:album:0"
+    },
+    "artists": [{"external_urls": {"spotify": "https://open.spotify.com/artist/0"}, "href": "https://api.spotify.com/v1/artists/0", "id": "0", "name": "Artist", "type": "artist", "uri": "spotify:artist:0"}],
+    "available_markets": ["AD", "AE", "AG", "AL", "AM", "AO", "AR", "AT", "AU", "AZ", "BA", "BB", "BD", "BE", "BF", "BG", "BH", "BI", "BJ", "BN", "BO", "BR", "BS", "BT", "BW", "BY", "BZ", "CA", "CD", "CG", "CH", "CI", "CL", "CM", "CO", "CR", "CV", "CW", "CY", "CZ", "DE", "DJ", "DK", "DM", "DO", "DZ", "EC", "EE", "EG", "ES", "US"],
+    "disc_number": 1,
+    "duration_ms": 215000,
+    "explicit": False,
+    "external_ids": {"isrc": "USAAA0000000"},
+    "external_urls": {"spotify": "https://open.spotify.com/track/0"},
+    "href": "https://api.spotify.com/v1/tracks/0",
+    "id": "0",
+    "is_local": False,
+    "name": "Song",
+    "popularity": 50,
+    "preview_url": "https://p.scdn.co/mp3-preview/0",
+    "track_number": 1,
+    "type": "track",
+    "uri": "spotify:track:0"
+}
+CATALOGUE_SIZE = 50000
+
+class MockSpotifyAdapter(BaseAdapter):
+    # Transport adapter standing in for accounts.spotify.com and api.spotify.com.
+    # Every response is built from RECORDED_TRACK, waits latency seconds and
+    # is a 429 with probability error_rate.
+    def __init__(self, latency: float = 0.05, error_rate: float = 0, retry_after: float = 0.01) -> None:
+        super().__init__()
+        self.latency = latency
+        self.errorRate = error_rate
+        self.retryAfter = retry_after
+        self.requests = 0
+        self.errors = 0
+        self.bytes = 0
+        self.lock = threading.Lock()
+
+    def send(self, request, **kwargs) -> Response:
+        time.sleep(self.latency)
+        url = urlparse(request.url)
+        query = {key: values[0] for key, values in parse_qs(url.query).items()}
+        response = Response()
+        response.url = request.url
+        response.request = request
+        response.encoding = "utf-8"
+        response.headers = CaseInsensitiveDict({"Content-Type": "application/json"})
+        with self.lock:
+            self.requests += 1
+            failed = not url.path.endswith("/token") and random.random() < self.errorRate
+            self.errors += failed
+        if failed:
+            response.status_code = 429
+            response.headers["Retry-After"] = str(self.retryAfter)
+            response._content = b"{}"
+            return response
+        if url.path.endswith("/token"):
+            body = {"access_token": "benchmark", "token_type": "Bearer", "expires_in": 3600}
+        elif url.path.endswith("/search"):
+            body = {"tracks": {"href": request.url, "items": [self.track(self.trackNumber(query["q"]))], "limit": 1, "next": None, "offset": 0, "previous": None, "total": 1}}
+        elif url.path.endswith("/audio-features"):
+            body = {"audio_features": [self.features(id) for id in query["ids"].split(",")]}
+        else:
+            seed = random.Random(query["seed_tracks"] + str(random.random()))
+            body = {"tracks": [self.track(seed.randrange(CATALOGUE_SIZE)) for _ in range(int(query["limit"]))], "seeds": []}
+        response.status_code = 200
+        response._content = json.dumps(body).encode()
+        with self.lock:
+            self.bytes += len(response._content)
+        return response
+
+    def close(self) -> None:
+        pass
+
+    @staticmethod
+    def trackNumber(query: str) -> int:
+        return int(hashlib.md5(query.encode()).hexdigest(), 16) % CATALOGUE_SIZE
+
+    @staticmethod
+    def trackId(number: int) -> str:
+        return hashlib.md5(str(number).encode()).hexdigest()[:22]
+
+    def track(self, number: int) -> dict:
+        track = copy.deepcopy(RECORDED_TRACK)
+        track["id"] = self.trackId(number)
+        track["name"] = "Song " + str(number)
+        track["artists"][0]["name"] = "Artist " + str(number % 997)
+        track["album"]["name"] = "Album " + str(number % 4999)
+        track["href"] = "https://api.spotify.com/v1/tracks/" + track["id"]
+        track["external_ids"]["isrc"] = "USAAA" + str(number).zfill(7)
+        return track
+
+    def features(self, id: str) -> dict:
+        rng = random.Random(id)
+        features = {field: rng.random() for field in MODEL_FIELDS}
+        features["loudness"] = -60 * rng.random()
+        features.update({
+            "duration_ms": rng.randrange(120000, 400000), "key": rng.randrange(12), "mode": rng.randrange(2),
+            "tempo": rng.uniform(60, 180), "time_signature": 4, "type": "audio_features", "id": id,
+            "uri": "spotify:track:" + id, "track_href": "https://api.spotify.com/v1/tracks/" + id,
+            "analysis_url": "https://api.spotify.com/v1/audio-analysis/" + id
+        })
+        return features
+
+def timeit(fn, repeat: int) -> float:
+    best = float("inf")
+    for _ in range(repeat):
+        start = time.perf_counter()
+        fn()
+        best = min(best, time.perf_counter() - start)
+    return best
+
+def benchSeeds(sizes: list[int], limit: int, repeat: int) -> None:
+    # Seed selection cost against library size, full sort vs partial sort vs diverse selection
+    metric = Metric()
+    rng = np.random.default_rng(0)
+    print("%10s %12s %12s %12s" % ("tracks", "argsort ms", "select ms", "mmr ms"))
+    for size in sizes:
+        matrix = rng.random((size, len(MODEL_FIELDS)))
+        matrix[:, -1] = matrix[:, -1] * -60
+        vector = matrix.mean(axis=0)
+        dist = metric.distances(matrix, vector)
+        full = timeit(lambda: metric.distances(matrix, vector).argsort()[:limit], repeat)
+        partial = timeit(lambda: selectSeeds(matrix, vector, metric, limit), repeat)
+        diverse = timeit(lambda: selectSeeds(matrix, vector, metric, limit, diversity=0.5), repeat)
+        assert (dist.argsort()[:limit] == selectSeeds(matrix, vector, metric, limit)).all()
+        print("%10d %12.3f %12.3f %12.3f" % (size, full * 1000, partial * 1000, diverse * 1000))
+
+STAGES = ["search", "audio_features", "model", "seeds", "recommendations", "dedupe"]
+
+def benchRun(sizes: list[int], limit: int, latency: float, error_rate: float, rate: float, warm: bool) -> None:
+    # Times every stage of PlaylistBuilder.run against the mock API, cold and then warm when asked
+    print("%8s %6s %9s %9s %9s %9s %9s %9s %9s %9s %8s %8s" % ("seeds", "pass", "search", "features", "model", "seeds", "recs", "dedupe", "total ms", "tracks/s", "requests", "429s"))
+    for size in sizes:
+        with tempfile.TemporaryDirectory() as directory:
+            cwd = os.getcwd()
+            os.chdir(directory)
+            try:
+                adapter = MockSpotifyAdapter(latency, error_rate)
+                tokenManager = TokenManager("benchmark", "benchmark")
+                tokenManager.getSession().mount("https://", adapter)
+                builder = PlaylistBuilder("benchmark", "benchmark", rate_limiter=RateLimiter(rate, rate), token_manager=tokenManager)
+                builder.getSession().mount("https://", adapter)
+                tracks = [Track(track_info=TrackInfo(name="Seed " + str(i), artist="Artist " + str(i % 997))) for i in range(size)]
+                for label in ["cold", "warm"] if warm else ["cold"]:
+                    requests, errors = adapter.requests, adapter.errors
+                    timings, total = benchStages(builder, tracks, limit)
+                    print("%8d %6s %9.1f %9.1f %9.1f %9.1f %9.1f %9.1f %9.1f %9.0f %8d %8d" % (size, label, *[t * 1000 for t in timings], total * 1000, size / total, adapter.requests - requests, adapter.errors - errors))
+            finally:
+                os.chdir(cwd)
+
+def stageSeconds(builder: PlaylistBuilder) -> dict:
+    return {histogram["labels"]["stage"]: histogram["sum"] for histogram in builder.metrics.toJson()["histograms"] if histogram["name"] == "stage_seconds"}
+
+def benchStages(builder: PlaylistBuilder, tracks: list[Track], limit: int) -> tuple[list[float], float]:
+    # Runs the real build path, bypassing only the playlist cache, and reads the stage
+    # timers it records. Stages of concurrent recommend() calls add up past wall clock.
+    before = stageSeconds(builder)
+    start = time.perf_counter()
+    builder.run(limit, tracks, cache=False)
+    total = time.perf_counter() - start
+    after = stageSeconds(builder)
+    return [after.get(stage, 0) - before.get(stage, 0) for stage in STAGES], total
+
+def benchStartup(repeat: int, top: int) -> None:
+    # Import cost of the module from -X importtime, then wall clock of a CLI invocation that exits early
+    here = os.path.dirname(os.path.abspath(__file__))
+    code = "import sys, playlistBuilder; print(*[name for name in ('numpy', 'requests', 'http.server', 'multiprocessing') if name in sys.modules])"
+    result = subprocess.run([sys.executable, "-X", "importtime", "-c", code], cwd=here, capture_output=True, text=True, check=True)
+    imports = []
+    for line in result.stderr.splitlines():
+        if not line.startswith("import time:") or "cumulative" in line:
+            continue
+        own, cumulative, name = line[len("import time:"):].split("|")
+        imports.append((int(own), int(cumulative), name.rstrip()))
+    total = next(cumulative for own, cumulative, name in imports if name.strip() == "playlistBuilder")
+    print("import playlistBuilder: %.1f ms cumulative" % (total / 1000))
+    print("heavy modules loaded at import: %s" % (result.stdout.strip() or "none"))
+    print("%10s %10s  %s" % ("self ms", "cum ms", "module"))
+    for own, cumulative, name in sorted(imports, reverse=True)[:top]:
+        print("%10.1f %10.1f  %s" % (own / 1000, cumulative / 1000, name))
+    cli = timeit(lambda: subprocess.run([sys.executable, "playlistBuilder.py", "--help"], cwd=here, capture_output=True, check=True), repeat)
+    print("playlistBuilder.py --help: %.1f ms wall clock" % (cli * 1000))
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="playlistBuilder benchmarks")
+    parser.add_argument("--repeat", type=int, default=5)
+    subparsers = parser.add_subparsers(dest="benchmark", required=True)
+    seeds = subparsers.add_parser("seeds", help="seed selection scaling vs library size")
+    seeds.add_argument("--sizes", type=int, nargs="+", default=[1000, 10000, 100000, 1000000])
+    seeds.add_argument("--limit", type=int, default=5)
+    run = subparsers.add_parser("run", help="per-stage timings of a playlist build against a mock API")
+    run.add_argument("--sizes", type=int, nargs="+", default=[10, 100, 1000, 10000])
+    run.add_argument("--limit", type=int, default=20)
+    run.add_argument("--latency", type=float, default=0.05, help="seconds added to every mock response")
+    run.add_argument("--error-rate", type=float, default=0, help="share of API responses that are 429s")
+    run.add_argument("--rate", type=float, default=1000, help="rate limiter requests per second")
+    run.add_argument("--cold-only", action="store_true", help="skip the second, warm cache pass")
+    startup = subparsers.add_parser("startup", help="import time and CLI startup cost")
+    startup.add_argument("--top", type=int, default=10, help="number of slowest imports to list")
+    args = parser.parse_args()
+
+    if args.benchmark == "seeds":
+        benchSeeds(args.sizes, args.limit, args.repeat)
+    elif args.benchmark == "run":
+        benchRun(args.sizes, args.limit, args.latency, args.error_rate, args.rate, not args.cold_only)
+    elif args.benchmark == "startup":
+        benchStartup(args.repeat, args.top)
@@ -1,24 +1,148 @@
-import requests
-from requests_cache import CachedSession
+from __future__ import annotations
 import os
-from urllib.parse import quote
-import numpy as np
+from urllib.parse import quote, urlencode
+import importlib
 import time
+import math
+import random
 import sys
 import json
+import argparse
+import threading
+import sqlite3
+import zlib
+import hashlib
+import re
+import unicodedata
+from collections import OrderedDict
+from contextlib import contextmanager
+from bisect import bisect_left
+from itertools import accumulate
+from concurrent.futures import ThreadPoolExecutor, FIRST_COMPLETED, wait
+
+# Fastest available JSON decoder for API responses and stored documents
+try:
+    from orjson import loads
+except ImportError:
+    try:
+        from msgspec.json import decode as loads
+    except ImportError:
+        from json import loads
+
+class LazyModule:
+    # Imports the module on first attribute access so startup and cached lookups don't pay for it
+    def __init__(self, name: str) -> None:
+        self.name = name
+        self.module = None
+        self.lock = threading.Lock()
+
+    def __getattr__(self, attribute: str):
+        if self.module is None:
+            with self.lock:
+                if self.module is None:
+                    self.module = importlib.import_module(self.name)
+        return getattr(self.module, attribute)
+
+np = LazyModule("numpy")
+requests = LazyModule("requests")
+multiprocessing = LazyModule("multiprocessing")
 
 VERBOSE = False
+MODEL_FIELDS = ["acousticness", "danceability", "energy", "instrumentalness", "liveness", "speechiness", "valence", "loudness"]
+# AudioFeatures drops its url, track_href and analysis_url strings when False
+KEEP_URLS = True
+# Range of every MODEL_FIELDS feature, loudness is in dB
+FEATURE_BOUNDS = [(0, 1)] * 7 + [(-60, 0)]
+MAX_WORKERS = 8
+RATE_LIMIT = 10 # requests per second
+RATE_BURST = 10
+MAX_RETRIES = 5
+BACKOFF_BASE = 0.5 # seconds
+BACKOFF_MAX = 30 # seconds
+AUDIO_FEATURES_CHUNK = 100 # API maximum ids per request
+STORE_PATH = "store.sqlite"
+SEARCH_TTL = 30 * 24 * 3600 # seconds
+SEARCH_CACHE_SIZE = 10000
+SEARCH_STORE_SIZE = 100000 # rows kept in the store file
+SEARCH_PRUNE_INTERVAL = 100 # writes between prunes of the store file
+RESPONSE_TTL = 3600 # seconds
+PLAYLIST_TTL = 3600 # seconds
+PLAYLIST_CACHE_SIZE = 1000
+LATENCY_BUCKETS = [0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, float("inf")] # seconds
+TOKEN_PATH = "token.json"
+TOKEN_REFRESH_MARGIN = 60 # seconds before expiry
+POOL_HOSTS = 1 # each session talks to one host, the builder's to api.spotify.com and TokenManager's to accounts.spotify.com
+RECOMMENDATIONS_MAX = 100 # API maximum limit per request
+TOP_UP_ROUNDS = 3
+KEEP_RATE_SMOOTHING = 0.2
+KEEP_RATE_MIN = 0.1
+SEED_POOL_FACTOR = 4 # candidates per seed considered for diverse seed selection
+INDEX_PROBES = 4 # clusters scanned per local query
+INDEX_EXACT_SIZE = 2048 # below this a brute force scan is cheaper than clustering
+INDEX_ITERATIONS = 10
+INDEX_TTL = 3600 # seconds before the local index is rebuilt from the store
+
+def trimTrack(track: dict) -> dict:
+    # The parts of an API track object parseTrack reads, dropping markets, images, urls and the rest
+    return {
+        "name": track["name"],
+        "artists": [{"name": artist["name"]} for artist in track["artists"][:1]],
+        "album": {"name": track["album"]["name"], "release_date": track["album"]["release_date"]},
+        "id": track["id"],
+        "href": track["href"],
+        "external_ids": {"isrc": track["external_ids"]["isrc"]} if track.get("external_ids", {}).get("isrc") else {}
+    }
+
+def configureSession(session: requests.Session, pool_size: int) -> requests.Session:
+    # Keep up to pool_size connections alive per host and make extra threads wait for one
+    # instead of opening (and TLS handshaking) throwaway connections
+    from requests.adapters import HTTPAdapter
+    adapter = HTTPAdapter(pool_connections=POOL_HOSTS, pool_maxsize=pool_size, pool_block=True)
+    session.mount("https://", adapter)
+    session.mount("http://", adapter)
+    session.headers["Connection"] = "keep-alive"
+    return session
+
+def normalize(text: str) -> str:
+    text = unicodedata.normalize("NFKC", text).casefold()
+    text = re.sub(r"[^\w\s]", " ", text)
+    return " ".join(text.split())
+
+# Trailing " - 2019 Remaster", "(Remastered 1993)", "[Live]" and similar release markers
+RELEASE_SUFFIX = re.compile(r"\s*(?:-\s|\(|\[)[^()\[\]]*\b(?:remaster(?:ed)?|version|mono|stereo|edit|mix|live|deluxe|anniversary)\b[^()\[\]]*[)\]]?\s*$", re.IGNORECASE)
+
+def normalizeTitle(title: str) -> str:
+    stripped = RELEASE_SUFFIX.sub("", title)
+    while stripped != title and stripped:
+        title, stripped = stripped, RELEASE_SUFFIX.sub("", stripped)
+    return normalize(title)
+
+def intern(text: str) -> str:
+    # Artists, albums and years repeat across a catalogue, keep one copy of each
+    return sys.intern(text) if isinstance(text, str) else text
 
 class TrackInfo:
+    __slots__ = ("name", "artist", "album", "year", "id", "href")
+
     def __init__(self, name: str= None, artist: str= None, album: str= None, year: int= None, id: str = None, href: str = None, releaseDate: str = None) -> None:
         self.name = name
-        self.artist = artist
-        self.album = album
-        self.year = year
+        self.artist = intern(artist)
+        self.album = intern(album)
+        self.year = intern(year)
         self.id = id
         self.href = href
         if releaseDate:
-            self.year = releaseDate[-4:]
+            self.year = intern(releaseDate[-4:])
+
+    def toDict(self) -> dict:
+        return {
+            "name": self.name,
+            "artist": self.artist,
+            "album": self.album,
+            "year": self.year,
+            "id": self.id,
+            "href": self.href
+        }
 
     def genQuery(self) -> str:
         qName = "track:"+self.name if self.name else None
@@ -29,7 +153,13 @@ class TrackInfo:
         q = " ".join([x for x in q if x])
         return quote(q)
 
+    def genKey(self) -> str:
+        # Search queries that only differ in case, spacing or punctuation share a key
+        return "|".join(normalize(str(x)) if x else "" for x in [self.name, self.artist, self.album, self.year])
+
 class AudioFeatures:
+    __slots__ = ("duration_ms", "key", "mode", "tempo", "time_signature", "url", "type", "id", "uri", "track_href", "analysis_url", "model")
+
     def __init__(self, acousticness: float= None, danceability: float= None, duration_ms: int= None, energy: float= None, instrumentalness: float= None, key: int= None, liveness: float= None, loudness: float= None, 
         mode: int= None, speechiness: float= None, tempo: float= None, time_signature: int= None, valence: float= None, url: str= None, type: str = None, id: str = None, uri: str = None, track_href: str =None, analysis_url:str =None) -> None:
         self.duration_ms = duration_ms
@@ -37,15 +167,17 @@ class AudioFeatures:
         self.mode = mode
         self.tempo = tempo
         self.time_signature = time_signature
-        self.url = url
-        self.type = type
+        self.url = url if KEEP_URLS else None
+        self.type = intern(type)
         self.id = id
         self.uri = uri
-        self.track_href = track_href
-        self.analysis_url = analysis_url
+        self.track_href = track_href if KEEP_URLS else None
+        self.analysis_url = analysis_url if KEEP_URLS else None
         self.model = AudioModel(acousticness, danceability, energy, instrumentalness, liveness, speechiness, valence, loudness)
 
 class AudioModel:
+    __slots__ = ("acousticness", "danceability", "energy", "instrumentalness", "liveness", "speechiness", "valence", "loudness")
+
     def __init__(self, acousticness: float= None, danceability: float= None, energy: float= None, instrumentalness: float= None, liveness: float= None, speechiness: float= None, valence: float= None, loudness: float= None) -> None:
         self.acousticness = acousticness
         self.danceability = danceability
@@ -60,50 +192,904 @@ class AudioModel:
         return np.array([self.acousticness, self.danceability, self.energy, self.instrumentalness, self.liveness, self.speechiness, self.valence, self.loudness])
 
 class Track:
-    def __init__(self, audio_features: AudioFeatures = None, track_info: TrackInfo = None) -> None:
+    __slots__ = ("audio_features", "track_info", "isrc")
+
+    def __init__(self, audio_features: AudioFeatures = None, track_info: TrackInfo = None, isrc: str = None) -> None:
         self.audio_features = audio_features
         self.track_info = track_info
+        self.isrc = isrc
+
+    def toData(self) -> dict:
+        return {**self.track_info.toDict(), "isrc": self.isrc}
+
+    @classmethod
+    def fromData(cls, data: dict) -> "Track":
+        data = dict(data)
+        isrc = data.pop("isrc", None)
+        return cls(track_info=TrackInfo(**data), isrc=isrc)
+
+    def genDedupeKeys(self) -> list[tuple]:
+        # Remasters and alternate releases share an ISRC or a normalized title and artist
+        keys = [("id", self.track_info.id)]
+        if self.isrc:
+            keys.append(("isrc", self.isrc))
+        if self.track_info.name:
+            keys.append(("title", normalizeTitle(self.track_info.name), normalize(self.track_info.artist or "")))
+        return keys
+
+class RateLimiter:
+    # Token bucket shared by every thread of a builder
+    def __init__(self, rate: float = RATE_LIMIT, burst: int = RATE_BURST) -> None:
+        self.rate = rate
+        self.burst = burst
+        self.tokens = burst
+        self.updated = time.monotonic()
+        self.pausedUntil = 0
+        self.lock = threading.Lock()
+
+    def acquire(self) -> None:
+        while True:
+            with self.lock:
+                now = time.monotonic()
+                if now < self.pausedUntil:
+                    wait = self.pausedUntil - now
+                else:
+                    self.tokens = min(self.burst, self.tokens + (now - max(self.updated, self.pausedUntil)) * self.rate)
+                    self.updated = now
+                    if self.tokens >= 1:
+                        self.tokens -= 1
+                        return
+                    wait = (1 - self.tokens) / self.rate
+            time.sleep(wait)
+
+    def pause(self, seconds: float) -> None:
+        # Stop every caller until the API is willing to take requests again
+        with self.lock:
+            self.pausedUntil = max(self.pausedUntil, time.monotonic() + seconds)
+            self.tokens = 0
+
+    def backoff(self, attempt: int) -> float:
+        # Exponential backoff with full jitter
+        return random.uniform(0, min(BACKOFF_MAX, BACKOFF_BASE * 2 ** attempt))
+
+class SharedRateLimiter(RateLimiter):
+    # Token bucket kept in shared memory so forked worker processes spend one global budget.
+    # time.monotonic() is system wide, so timestamps compare across processes.
+    def __init__(self, rate: float = RATE_LIMIT, burst: int = RATE_BURST) -> None:
+        self.rate = rate
+        self.burst = burst
+        self.state = multiprocessing.Array("d", [burst, time.monotonic(), 0], lock=False)
+        self.lock = multiprocessing.Lock()
+
+    @property
+    def tokens(self) -> float:
+        return self.state[0]
+
+    @tokens.setter
+    def tokens(self, value: float) -> None:
+        self.state[0] = value
+
+    @property
+    def updated(self) -> float:
+        return self.state[1]
+
+    @updated.setter
+    def updated(self, value: float) -> None:
+        self.state[1] = value
+
+    @property
+    def pausedUntil(self) -> float:
+        return self.state[2]
+
+    @pausedUntil.setter
+    def pausedUntil(self, value: float) -> None:
+        self.state[2] = value
+
+class Metrics:
+    # Counters and latency histograms keyed by name and labels, exported as Prometheus text or JSON
+    def __init__(self, prefix: str = "playlist_builder") -> None:
+        self.prefix = prefix
+        self.counters = {}
+        self.histograms = {}
+        self.lock = threading.Lock()
+
+    def __getstate__(self) -> dict:
+        # Worker processes send their metrics back to the parent, the lock stays behind
+        with self.lock:
+            return {"prefix": self.prefix, "counters": self.counters, "histograms": self.histograms}
+
+    def __setstate__(self, state: dict) -> None:
+        self.__dict__.update(state)
+        self.lock = threading.Lock()
+
+    def merge(self, other: "Metrics") -> None:
+        with self.lock:
+            for key, value in other.counters.items():
+                self.counters[key] = self.counters.get(key, 0) + value
+            for key, histogram in other.histograms.items():
+                merged = self.histograms.setdefault(key, {"buckets": [0] * len(LATENCY_BUCKETS), "sum": 0, "count": 0})
+                merged["buckets"] = [a + b for a, b in zip(merged["buckets"], histogram["buckets"])]
+                merged["sum"] += histogram["sum"]
+                merged["count"] += histogram["count"]
+
+    def increment(self, name: str, value: float = 1, **labels) -> None:
+        key = (name, tuple(sorted(labels.items())))
+        with self.lock:
+            self.counters[key] = self.counters.get(key, 0) + value
+
+    def observe(self, name: str, seconds: float, **labels) -> None:
+        key = (name, tuple(sorted(labels.items())))
+        with self.lock:
+            histogram = self.histograms.setdefault(key, {"buckets": [0] * len(LATENCY_BUCKETS), "sum": 0, "count": 0})
+            histogram["buckets"][bisect_left(LATENCY_BUCKETS, seconds)] += 1
+            histogram["sum"] += seconds
+            histogram["count"] += 1
+
+    @contextmanager
+    def timer(self, name: str, **labels):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(name, time.perf_counter() - start, **labels)
+
+    def toJson(self) -> dict:
+        with self.lock:
+            counters = [{"name": name, "labels": dict(labels), "value": value} for (name, labels), value in sorted(self.counters.items())]
+            histograms = [{
+                "name": name,
+                "labels": dict(labels),
+                "buckets": dict(zip([str(bound) for bound in LATENCY_BUCKETS], accumulate(histogram["buckets"]))),
+                "sum": histogram["sum"],
+                "count": histogram["count"]
+            } for (name, labels), histogram in sorted(self.histograms.items())]
+        return {"counters": counters, "histograms": histograms}
+
+    def toPrometheus(self) -> str:
+        def formatLabels(labels: dict) -> str:
+            return "{" + ",".join('%s="%s"' % (key, str(value).replace('"', '\\"')) for key, value in labels.items()) + "}" if labels else ""
+
+        lines = []
+        metrics = self.toJson()
+        for name in dict.fromkeys(counter["name"] for counter in metrics["counters"]):
+            lines.append("# TYPE %s_%s counter" % (self.prefix, name))
+            lines += ["%s_%s%s %s" % (self.prefix, name, formatLabels(counter["labels"]), counter["value"]) for counter in metrics["counters"] if counter["name"] == name]
+        for name in dict.fromkeys(histogram["name"] for histogram in metrics["histograms"]):
+            lines.append("# TYPE %s_%s histogram" % (self.prefix, name))
+            for histogram in metrics["histograms"]:
+                if histogram["name"] != name:
+                    continue
+                for bound, count in histogram["buckets"].items():
+                    lines.append("%s_%s_bucket%s %d" % (self.prefix, name, formatLabels({**histogram["labels"], "le": "+Inf" if bound == "inf" else bound}), count))
+                lines.append("%s_%s_sum%s %s" % (self.prefix, name, formatLabels(histogram["labels"]), histogram["sum"]))
+                lines.append("%s_%s_count%s %d" % (self.prefix, name, formatLabels(histogram["labels"]), histogram["count"]))
+        return "\n".join(lines) + "\n"
+
+class Span:
+    # No-op span, tracers hand these out when nothing is recording
+    def set_attribute(self, key: str, value) -> None:
+        pass
+
+    def end(self) -> None:
+        pass
+
+class RecordedSpan(Span):
+    def __init__(self, tracer: "InMemoryTracer", name: str, attributes: dict, parent: Span) -> None:
+        self.tracer = tracer
+        self.name = name
+        self.attributes = dict(attributes)
+        self.parent = parent if isinstance(parent, RecordedSpan) else None
+        self.thread = threading.current_thread().name
+        self.start = time.time()
+        self.duration = None
+
+    def set_attribute(self, key: str, value) -> None:
+        self.attributes[key] = value
+
+    def end(self) -> None:
+        self.duration = time.time() - self.start
+        self.tracer.finish(self)
+
+class Tracer:
+    # No-op by default. Subclasses return spans from start(), the stack of open spans is per thread
+    def __init__(self) -> None:
+        self.local = threading.local()
+
+    @contextmanager
+    def span(self, name: str, **attributes):
+        span = self.start(name, attributes)
+        if not hasattr(self.local, "stack"):
+            self.local.stack = []
+        self.local.stack.append(span)
+        try:
+            yield span
+        except Exception as e:
+            span.set_attribute("error", repr(e))
+            raise
+        finally:
+            self.local.stack.pop()
+            span.end()
+
+    def current(self) -> Span:
+        stack = getattr(self.local, "stack", None)
+        return stack[-1] if stack else NOOP_SPAN
+
+    def start(self, name: str, attributes: dict) -> Span:
+        return NOOP_SPAN
+
+NOOP_SPAN = Span()
+
+class InMemoryTracer(Tracer):
+    # Keeps finished spans in memory, for tests and ad hoc latency digging
+    def __init__(self) -> None:
+        super().__init__()
+        self.spans = []
+        self.lock = threading.Lock()
+
+    def start(self, name: str, attributes: dict) -> Span:
+        return RecordedSpan(self, name, attributes, self.current())
+
+    def finish(self, span: RecordedSpan) -> None:
+        with self.lock:
+            self.spans.append(span)
+
+class OpenTelemetryTracer(Tracer):
+    # Exports through whatever OpenTelemetry SDK the host process configured, needs opentelemetry-api
+    def __init__(self, name: str = "playlistBuilder") -> None:
+        super().__init__()
+        from opentelemetry import trace
+        self.trace = trace
+        self.tracer = trace.get_tracer(name)
+
+    @contextmanager
+    def span(self, name: str, **attributes):
+        with self.tracer.start_as_current_span(name, attributes=attributes) as span:
+            yield span
+
+    def current(self):
+        return self.trace.get_current_span()
+
+class SqliteStore:
+    # Thread-safe table in the shared store file, subclasses provide the schema
+    SCHEMA = ""
+    QUERY_CHUNK = 500
+
+    def __init__(self, path: str = STORE_PATH) -> None:
+        self.path = path
+        self.lock = threading.Lock()
+        self.connection = sqlite3.connect(path, timeout=30, check_same_thread=False)
+        with self.lock, self.connection:
+            self.connection.execute("PRAGMA journal_mode=WAL")
+            self.connection.executescript(self.SCHEMA)
+
+    def close(self) -> None:
+        with self.lock:
+            self.connection.close()
+
+class IdStore(SqliteStore):
+    # Track id -> JSON document table, subclasses name the table
+    TABLE = ""
+
+    def __init__(self, path: str = STORE_PATH) -> None:
+        self.SCHEMA = "CREATE TABLE IF NOT EXISTS %s (id TEXT PRIMARY KEY, data TEXT NOT NULL);" % self.TABLE
+        super().__init__(path)
+
+    def getMany(self, ids: list[str]) -> dict:
+        items = {}
+        with self.lock:
+            for i in range(0, len(ids), self.QUERY_CHUNK):
+                chunk = ids[i:i + self.QUERY_CHUNK]
+                rows = self.connection.execute(
+                    "SELECT id, data FROM %s WHERE id IN (%s)" % (self.TABLE, ",".join("?" * len(chunk))), chunk
+                )
+                items.update((id, loads(data)) for id, data in rows)
+        return items
+
+    def getAll(self) -> dict:
+        with self.lock:
+            rows = self.connection.execute("SELECT id, data FROM %s" % self.TABLE).fetchall()
+        return {id: loads(data) for id, data in rows}
+
+    def getIds(self) -> set[str]:
+        with self.lock:
+            return {id for id, in self.connection.execute("SELECT id FROM %s" % self.TABLE)}
+
+    def putMany(self, items: dict) -> None:
+        with self.lock, self.connection:
+            self.connection.executemany(
+                "INSERT OR REPLACE INTO %s (id, data) VALUES (?, ?)" % self.TABLE,
+                [(id, json.dumps(item)) for id, item in items.items()]
+            )
+
+class FeatureStore(IdStore):
+    # Audio features never change, so they are kept per track id without expiry
+    TABLE = "audio_features"
+
+class TrackStore(IdStore):
+    # Track info for every track seen, so locally recommended ids can be returned as tracks
+    TABLE = "tracks"
+
+class SearchCache(SqliteStore):
+    # Normalized query -> track info, LRU in memory in front of the store file.
+    # Searches without a match are kept as {} so they aren't repeated either.
+    SCHEMA = """
+        CREATE TABLE IF NOT EXISTS searches (key TEXT PRIMARY KEY, data TEXT NOT NULL, created REAL NOT NULL);
+        CREATE INDEX IF NOT EXISTS searches_created ON searches (created);
+    """
+
+    def __init__(self, path: str = STORE_PATH, ttl: float = SEARCH_TTL, max_size: int = SEARCH_CACHE_SIZE, max_rows: int = SEARCH_STORE_SIZE) -> None:
+        super().__init__(path)
+        self.ttl = ttl
+        self.maxSize = max_size
+        self.maxRows = max_rows
+        self.memory = OrderedDict()
+        self.writes = 0
+        with self.lock, self.connection:
+            self.prune()
+
+    def get(self, key: str) -> dict:
+        now = time.time()
+        with self.lock:
+            if key in self.memory:
+                data, created = self.memory[key]
+                if now - created < self.ttl:
+                    self.memory.move_to_end(key)
+                    return data
+                del self.memory[key]
+            row = self.connection.execute("SELECT data, created FROM searches WHERE key = ?", (key,)).fetchone()
+            if not row or now - row[1] >= self.ttl:
+                return None
+            data = loads(row[0])
+            self.remember(key, data, row[1])
+            return data
+
+    def put(self, key: str, data: dict) -> None:
+        now = time.time()
+        with self.lock, self.connection:
+            self.connection.execute("INSERT OR REPLACE INTO searches (key, data, created) VALUES (?, ?, ?)", (key, json.dumps(data), now))
+            self.remember(key, data, now)
+            self.writes += 1
+            if self.writes % SEARCH_PRUNE_INTERVAL == 0:
+                self.prune()
+
+    def prune(self) -> None:
+        # Drops expired rows, negative {} entries included, then the oldest rows past maxRows.
+        # Callers hold the lock and the transaction.
+        self.connection.execute("DELETE FROM searches WHERE created < ?", (time.time() - self.ttl,))
+        self.connection.execute("DELETE FROM searches WHERE key IN (SELECT key FROM searches ORDER BY created DESC LIMIT -1 OFFSET ?)", (self.maxRows,))
+
+    def remember(self, key: str, data: dict, created: float) -> None:
+        self.memory[key] = (data, created)
+        self.memory.move_to_end(key)
+        while len(self.memory) > self.maxSize:
+            self.memory.popitem(last=False)
+
+class ResponseCache(SqliteStore):
+    # Trimmed API responses as zlib compressed JSON, keyed by url and sorted parameters
+    SCHEMA = "CREATE TABLE IF NOT EXISTS responses (key TEXT PRIMARY KEY, data BLOB NOT NULL, expires REAL NOT NULL);"
+
+    def __init__(self, path: str = STORE_PATH, ttl: float = RESPONSE_TTL) -> None:
+        super().__init__(path)
+        self.ttl = ttl
+        with self.lock, self.connection:
+            self.connection.execute("DELETE FROM responses WHERE expires < ?", (time.time(),))
+
+    def get(self, key: str) -> dict:
+        with self.lock:
+            row = self.connection.execute("SELECT data FROM responses WHERE key = ? AND expires >= ?", (key, time.time())).fetchone()
+        return loads(zlib.decompress(row[0])) if row else None
+
+    def put(self, key: str, data: dict) -> None:
+        compressed = zlib.compress(json.dumps(data, separators=(",", ":")).encode())
+        now = time.time()
+        with self.lock, self.connection:
+            # Keys carry float targets and keep rate sized limits so they rarely repeat, prune as we go
+            self.connection.execute("DELETE FROM responses WHERE expires < ?", (now,))
+            self.connection.execute("INSERT OR REPLACE INTO responses (key, data, expires) VALUES (?, ?, ?)", (key, compressed, now + self.ttl))
+
+class TokenManager:
+    # Client-credentials token persisted to TOKEN_PATH and shared by every builder and thread
+    managers = {}
+    managersLock = threading.Lock()
+
+    def __init__(self, client_id: str, client_secret: str, path: str = TOKEN_PATH, session: requests.Session = None) -> None:
+        self.client_id = client_id
+        self.client_secret = client_secret
+        self.path = path
+        self.session = session
+        self.token = None
+        self.expiresAt = 0
+        self.lock = threading.Lock()
+        self.load()
+
+    @classmethod
+    def shared(cls, client_id: str, client_secret: str) -> "TokenManager":
+        with cls.managersLock:
+            if client_id not in cls.managers:
+                cls.managers[client_id] = cls(client_id, client_secret)
+            return cls.managers[client_id]
+
+    def get(self, tracer: Tracer = None) -> str:
+        with self.lock:
+            if self.token is None or time.time() >= self.expiresAt - TOKEN_REFRESH_MARGIN:
+                with (tracer or Tracer()).span("spotify.auth") as span:
+                    self.getAuthtoken()
+                    span.set_attribute("expires_in", self.expiresAt - time.time())
+            return self.token
+
+    def invalidate(self, token: str) -> None:
+        # Only drop the token the caller was rejected with, another thread may have refreshed already
+        with self.lock:
+            if self.token == token:
+                self.token = None
+
+    def getSession(self) -> requests.Session:
+        # Only called while holding self.lock or before the manager is shared
+        if self.session is None:
+            self.session = configureSession(requests.Session(), pool_size=1)
+        return self.session
+
+    def getAuthtoken(self) -> None:
+        if (VERBOSE): print("GENERATING AUTH TOKEN")
+        response = self.getSession().post("https://accounts.spotify.com/api/token", data={"grant_type": "client_credentials", "client_id": self.client_id, "client_secret": self.client_secret})
+        response.raise_for_status()
+        data = loads(response.content)
+        self.token = "Bearer " + data["access_token"]
+        self.expiresAt = time.time() + data["expires_in"]
+        self.save()
+
+    def load(self) -> None:
+        try:
+            with open(self.path) as f:
+                data = json.load(f)
+        except (OSError, ValueError):
+            return
+        if data.get("client_id") == self.client_id:
+            self.token = data["token"]
+            self.expiresAt = data["expires_at"]
+
+    def save(self) -> None:
+        tmp = self.path + "." + str(os.getpid()) + ".tmp"
+        with open(os.open(tmp, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o600), "w") as f:
+            json.dump({"client_id": self.client_id, "token": self.token, "expires_at": self.expiresAt}, f)
+        os.replace(tmp, self.path)
+
+class TrackCollection:
+    # Tracks with their audio models stored as one contiguous (n, len(MODEL_FIELDS)) matrix
+    def __init__(self, tracks: list[Track], matrix: np.ndarray = None) -> None:
+        self.tracks = tracks
+        if matrix is None:
+            matrix = np.array([track.audio_features.model.getNumpyVector() for track in tracks], dtype=np.float64)
+        self.matrix = matrix.reshape(len(tracks), len(MODEL_FIELDS))
+        self.index = {track.track_info.id: i for i, track in enumerate(tracks)}
+
+    def __len__(self) -> int:
+        return len(self.tracks)
+
+    def __iter__(self):
+        return iter(self.tracks)
+
+    def __getitem__(self, i: int) -> Track:
+        return self.tracks[i]
+
+    def subset(self, tracks: list[Track]) -> "TrackCollection":
+        return TrackCollection(tracks, self.matrix[[self.index[track.track_info.id] for track in tracks]])
+
+class Metric:
+    # Feature scaling, weighting and distance shared by seed selection and the local index.
+    # embed() maps vectors into a space where euclidean distance ranks like the metric
+    # (cosine becomes the chord distance between unit vectors, mahalanobis a whitening),
+    # so every distance stays a single vectorized norm.
+    def __init__(self, scaling: str = "minmax", weights: list[float] = None, distance: str = "euclidean") -> None:
+        if scaling not in ("minmax", "zscore", None):
+            raise ValueError("Unknown scaling: " + str(scaling))
+        if distance not in ("euclidean", "cosine", "mahalanobis"):
+            raise ValueError("Unknown distance: " + str(distance))
+        self.scaling = scaling
+        self.distance = distance
+        self.weights = np.ones(len(MODEL_FIELDS)) if weights is None else np.asarray(weights, dtype=np.float64)
+        low, high = np.array(FEATURE_BOUNDS, dtype=np.float64).T
+        if scaling == "minmax":
+            self.offset, self.scale = low, high - low
+        elif scaling == "zscore":
+            # Until fit() sees real data assume features are uniform over their bounds
+            self.offset, self.scale = (low + high) / 2, (high - low) / math.sqrt(12)
+        else:
+            self.offset, self.scale = np.zeros(len(MODEL_FIELDS)), np.ones(len(MODEL_FIELDS))
+        self.whitening = None
+        self.fitted = False
+
+    def needsFit(self) -> bool:
+        # minmax scaling has fixed bounds, zscore and mahalanobis need statistics of a real library
+        return self.scaling == "zscore" or self.distance == "mahalanobis"
+
+    def fit(self, matrix: np.ndarray) -> "Metric":
+        # Precompute statistics from a reference library
+        if self.scaling == "minmax":
+            self.offset, self.scale = matrix.min(axis=0), matrix.max(axis=0) - matrix.min(axis=0)
+        elif self.scaling == "zscore":
+            self.offset, self.scale = matrix.mean(axis=0), matrix.std(axis=0)
+        self.scale = np.where(self.scale > 0, self.scale, 1)
+        if self.distance == "mahalanobis":
+            embedded = (matrix - self.offset) / self.scale * self.weights
+            values, vectors = np.linalg.eigh(np.cov(embedded, rowvar=False))
+            self.whitening = vectors / np.sqrt(np.maximum(values, 1e-12))
+        self.fitted = True
+        return self
+
+    def embed(self, matrix: np.ndarray) -> np.ndarray:
+        embedded = (matrix - self.offset) / self.scale * self.weights
+        if self.distance == "cosine":
+            embedded = embedded / np.maximum(np.linalg.norm(embedded, axis=-1, keepdims=True), 1e-12)
+        elif self.distance == "mahalanobis":
+            if self.whitening is None:
+                raise ValueError("Mahalanobis distance needs Metric.fit() before use")
+            embedded = embedded @ self.whitening
+        return embedded
+
+    def distances(self, matrix: np.ndarray, vector: np.ndarray) -> np.ndarray:
+        return np.linalg.norm(self.embed(matrix) - self.embed(vector), axis=1)
+
+def smallest(values: np.ndarray, k: int) -> np.ndarray:
+    # Indices of the k smallest values in order, partitioning before sorting only those k
+    if k < len(values):
+        indices = np.argpartition(values, k)[:k]
+    else:
+        indices = np.arange(len(values))
+    return indices[values[indices].argsort()]
+
+def selectSeeds(matrix: np.ndarray, vector: np.ndarray, metric: Metric, limit: int, diversity: float = 0) -> np.ndarray:
+    # Rows closest to vector. With diversity > 0 the nearest limit * SEED_POOL_FACTOR rows are
+    # re-ranked by maximal marginal relevance, trading closeness for distance to the rows already picked
+    dist = metric.distances(matrix, vector)
+    if diversity <= 0:
+        return smallest(dist, limit)
+    pool = smallest(dist, limit * SEED_POOL_FACTOR)
+    embedded = metric.embed(matrix[pool])
+    chosen = [0]
+    spread = np.linalg.norm(embedded - embedded[0], axis=1)
+    while len(chosen) < min(limit, len(pool)):
+        score = diversity * spread - (1 - diversity) * dist[pool]
+        score[chosen] = -np.inf
+        best = int(score.argmax())
+        chosen.append(best)
+        spread = np.minimum(spread, np.linalg.norm(embedded - embedded[best], axis=1))
+    return pool[chosen]
+
+class FeatureIndex:
+    # Inverted file index: vectors are bucketed under their nearest k-means centroid
+    # and a query only scans the buckets whose centroids are closest to it
+    def __init__(self, ids: list[str], matrix: np.ndarray, metric: Metric = None, probes: int = INDEX_PROBES) -> None:
+        self.ids = np.array(ids)
+        self.metric = metric or Metric()
+        self.matrix = matrix = self.metric.embed(matrix)
+        self.probes = probes
+        lists = 1 if len(ids) < INDEX_EXACT_SIZE else int(math.sqrt(len(ids)))
+        self.centroids = self.cluster(matrix, lists)
+        assignment = self.distances(matrix, self.centroids).argmin(axis=1)
+        self.buckets = [np.flatnonzero(assignment == i) for i in range(lists)]
+
+    @staticmethod
+    def distances(matrix: np.ndarray, centroids: np.ndarray) -> np.ndarray:
+        # Squared euclidean distance of every row to every centroid without an (n, k, d) temporary
+        return (matrix ** 2).sum(axis=1)[:, None] - 2 * matrix @ centroids.T + (centroids ** 2).sum(axis=1)[None, :]
+
+    def cluster(self, matrix: np.ndarray, lists: int) -> np.ndarray:
+        if lists == 1:
+            return matrix.mean(axis=0, keepdims=True)
+        rng = np.random.default_rng(0)
+        centroids = matrix[rng.choice(len(matrix), lists, replace=False)]
+        for _ in range(INDEX_ITERATIONS):
+            assignment = self.distances(matrix, centroids).argmin(axis=1)
+            counts = np.bincount(assignment, minlength=lists)
+            sums = np.zeros_like(centroids)
+            np.add.at(sums, assignment, matrix)
+            filled = counts > 0
+            centroids[filled] = sums[filled] / counts[filled, None]
+        return centroids
+
+    def query(self, vector: np.ndarray, k: int, exclude: set[str] = frozenset()) -> list[str]:
+        wanted = k + len(exclude)
+        vector = self.metric.embed(vector)
+        order = self.distances(vector[None, :], self.centroids)[0].argsort()
+        rows = []
+        size = 0
+        for i, bucket in enumerate(order):
+            if i >= self.probes and size >= wanted:
+                break
+            rows.append(self.buckets[bucket])
+            size += len(self.buckets[bucket])
+        rows = np.concatenate(rows)
+        dist = np.linalg.norm(self.matrix[rows] - vector, axis=1)
+        ids = [id for id in self.ids[rows[smallest(dist, wanted)]].tolist() if id not in exclude]
+        return ids[:k]
+
+class PlaylistCache(SqliteStore):
+    # Finished playlists keyed by a hash of the request, oldest entries are evicted past max_size
+    SCHEMA = "CREATE TABLE IF NOT EXISTS playlists (key TEXT PRIMARY KEY, data BLOB NOT NULL, created REAL NOT NULL);"
+
+    def __init__(self, path: str = STORE_PATH, ttl: float = PLAYLIST_TTL, max_size: int = PLAYLIST_CACHE_SIZE) -> None:
+        super().__init__(path)
+        self.ttl = ttl
+        self.maxSize = max_size
+
+    @staticmethod
+    def genKey(tracks: list[Track], limit: int, *options) -> str:
+        # Seed order doesn't change the playlist, so the normalized keys are sorted. Duplicates
+        # are kept since a repeated seed weighs more in the average model.
+        seeds = sorted(track.track_info.genKey() for track in tracks)
+        return hashlib.sha256(json.dumps([seeds, limit, *options], separators=(",", ":")).encode()).hexdigest()
+
+    def get(self, key: str) -> list[dict]:
+        with self.lock:
+            row = self.connection.execute("SELECT data FROM playlists WHERE key = ? AND created >= ?", (key, time.time() - self.ttl)).fetchone()
+        return loads(zlib.decompress(row[0])) if row else None
+
+    def put(self, key: str, data: list[dict]) -> None:
+        compressed = zlib.compress(json.dumps(data, separators=(",", ":")).encode())
+        now = time.time()
+        with self.lock, self.connection:
+            self.connection.execute("INSERT OR REPLACE INTO playlists (key, data, created) VALUES (?, ?, ?)", (key, compressed, now))
+            self.connection.execute("DELETE FROM playlists WHERE created < ?", (now - self.ttl,))
+            self.connection.execute("DELETE FROM playlists WHERE key IN (SELECT key FROM playlists ORDER BY created DESC LIMIT -1 OFFSET ?)", (self.maxSize,))
 
 class PlaylistBuilder:
-    def __init__(self, client_id: str, client_secret: str, tracks: list[Track]) -> None:
+    def __init__(self, client_id: str, client_secret: str, tracks: list[Track] = None, max_workers: int = MAX_WORKERS, rate_limiter: RateLimiter = None, feature_store: FeatureStore = None, search_cache: SearchCache = None, token_manager: TokenManager = None, pool_size: int = None, track_store: TrackStore = None, response_cache: ResponseCache = None, recommender: str = "remote", metric: Metric = None, seed_diversity: float = 0, metrics: Metrics = None, tracer: Tracer = None, playlist_cache: PlaylistCache = None, cache_playlists: bool = True) -> None:
         self.client_id = client_id
         self.client_secret = client_secret
         self.tracks = tracks
-        self.auth = self.getAuthtoken(client_id, client_secret)
-        self.session = CachedSession(cache_name="cache", backend="sqlite", expire_after=3600)
-
-    def run(self, limit: int):
-        tracks = [self.searchTrack(track) for track in self.tracks]
-        tracks = [track for track in tracks if track]
-        tracks = self.getAudioFeatures(tracks)
-        model = self.genAverageModel(tracks)
-        seeds = self.getBestSeeds(tracks, model)
-        recommendedSongs = self.getModelRecommendations(model, seeds, limit=limit)
-        # Remove duplicates
-        recommendedSongs = [track for track in recommendedSongs if track.track_info.id not in [track.track_info.id for track in tracks]]
-        if len(recommendedSongs) > limit:
-            recommendedSongs = recommendedSongs[:limit]
-        # Make playlist a set to remove duplicates
+        self.tokenManager = token_manager or TokenManager.shared(client_id, client_secret)
+        # Created on first request, a fully cached build never imports requests
+        self.session = None
+        self.poolSize = pool_size or max_workers
+        self.sessionLock = threading.Lock()
+        self.responseCache = response_cache or ResponseCache()
+        self.playlistCache = playlist_cache or PlaylistCache()
+        # Default for run(), a bypassed build still refreshes its cache entry
+        self.cachePlaylists = cache_playlists
+        self.rateLimiter = rate_limiter or RateLimiter()
+        self.executor = ThreadPoolExecutor(max_workers=max_workers)
+        self.featureStore = feature_store or FeatureStore()
+        self.searchCache = search_cache or SearchCache()
+        self.trackStore = track_store or TrackStore()
+        # "remote" uses /v1/recommendations, "local" the FeatureIndex, "blend" interleaves both.
+        # The index is built from the stores alone, without network calls, over tracks whose features
+        # were stored by earlier remote or blend builds. "local" needs such a warmed store; on a
+        # fresh one it only knows the request's own seeds, which are excluded.
+        self.recommender = recommender
+        self.metric = metric
+        self.metricLock = threading.Lock()
+        self.seedDiversity = seed_diversity
+        self.metrics = metrics or Metrics()
+        self.tracer = tracer or Tracer()
+        self.localIndex = None
+        self.localIndexBuilt = 0
+        self.localIndexLock = threading.Lock()
+        # Share of recommendations that survive dedupe, used to size requests
+        self.keepRate = 1.0
+        self.keepRateLock = threading.Lock()
+
+    def run(self, limit: int, tracks: list[Track] = None, cache: bool = None):
+        # A cached playlist is returned before any search, numpy or HTTP work
+        tracks = self.tracks if tracks is None else tracks
+        # An unset metric is the default one, described without building it so a hit skips numpy
+        metric = [self.metric.scaling, self.metric.distance, self.metric.weights.tolist()] if self.metric else ["minmax", "euclidean", [1.0] * len(MODEL_FIELDS)]
+        key = PlaylistCache.genKey(tracks, limit, self.recommender, self.seedDiversity, *metric)
+        if self.cachePlaylists if cache is None else cache:
+            data = self.playlistCache.get(key)
+            self.metrics.increment("cache_requests_total", cache="playlists", result="miss" if data is None else "hit")
+            if data is not None:
+                return [Track.fromData(track) for track in data]
+        playlist = self.runBatch([(tracks, limit)])[0]
+        if playlist:
+            self.playlistCache.put(key, [track.toData() for track in playlist])
+        return playlist
+
+    def runBatch(self, jobs: list[tuple[list[Track], int]]) -> list[list[Track]]:
+        # Every unique search and feature lookup is fetched once for the whole batch
+        queries = {}
+        for tracks, limit in jobs:
+            for track in tracks:
+                queries.setdefault(track.track_info.genKey(), track)
+        with self.metrics.timer("stage_seconds", stage="search"):
+            found = dict(zip(queries, self.searchTracks(list(queries.values()))))
+        with self.metrics.timer("stage_seconds", stage="audio_features"):
+            resolved = self.getAudioFeatures([track for track in found.values() if track])
+        playlists = []
+        for tracks, limit in jobs:
+            tracks = [found[track.track_info.genKey()] for track in tracks]
+            tracks = [track for track in tracks if track and track.track_info.id in resolved.index]
+            playlists.append((resolved.subset(tracks), limit))
+        return list(self.executor.map(lambda job: self.recommend(*job), playlists))
+
+    def recommend(self, tracks: TrackCollection, limit: int) -> list[Track]:
+        if not tracks:
+            return []
+        with self.metrics.timer("stage_seconds", stage="model"):
+            model = self.genAverageModel(tracks)
+        with self.metrics.timer("stage_seconds", stage="seeds"):
+            seeds = self.getBestSeeds(tracks, model)
+        return self.fillRecommendations(model, seeds, tracks, limit)
+
+    def fillRecommendations(self, model: AudioModel, seeds: list[Track], exclude: list[Track], limit: int) -> list[Track]:
+        # Over-fetch by the observed keep rate and top up until the playlist is full
+        playlist = []
+        for round in range(TOP_UP_ROUNDS):
+            needed = limit - len(playlist)
+            size = min(RECOMMENDATIONS_MAX, math.ceil(needed / max(self.keepRate, KEEP_RATE_MIN)))
+            if (VERBOSE and round): print("TOPPING UP " + str(needed) + " RECOMMENDATIONS")
+            # A repeated cached request would return the same tracks again
+            with self.metrics.timer("stage_seconds", stage="recommendations"):
+                recommendedSongs = self.getRecommendations(model, seeds, list(exclude) + playlist, size, cache=round == 0)
+            if not recommendedSongs:
+                break
+            with self.metrics.timer("stage_seconds", stage="dedupe"):
+                kept = self.dedupe(recommendedSongs, list(exclude) + playlist)
+            with self.keepRateLock:
+                self.keepRate += KEEP_RATE_SMOOTHING * (len(kept) / len(recommendedSongs) - self.keepRate)
+            playlist += kept
+            if len(playlist) >= limit:
+                break
+        return playlist[:limit]
+
+    def getRecommendations(self, model: AudioModel, seeds: list[Track], exclude: list[Track], limit: int, cache: bool = True) -> list[Track]:
+        if self.recommender == "local":
+            return self.getLocalRecommendations(model, exclude, limit)
+        try:
+            recommendedSongs = self.getModelRecommendations(model, seeds, limit=limit, cache=cache)
+        except (requests.ConnectionError, requests.Timeout, requests.HTTPError) as e:
+            # Only an unreachable or overloaded API falls back, get() has already retried 429s and 5xx.
+            # Client errors such as a bad token or request are raised as before.
+            status = e.response.status_code if isinstance(e, requests.HTTPError) and e.response is not None else None
+            if status is not None and status != 429 and status < 500:
+                raise
+            if (VERBOSE): print("REMOTE RECOMMENDATIONS FAILED, USING LOCAL INDEX: " + str(e))
+            self.metrics.increment("recommendation_fallbacks_total", reason=str(status or type(e).__name__))
+            localSongs = self.getLocalRecommendations(model, exclude, limit)
+            if not localSongs:
+                raise
+            return localSongs
+        if self.recommender == "blend":
+            localSongs = self.getLocalRecommendations(model, exclude, limit)
+            blended = [track for pair in zip(recommendedSongs, localSongs) for track in pair]
+            pairs = min(len(recommendedSongs), len(localSongs))
+            return blended + recommendedSongs[pairs:] + localSongs[pairs:]
         return recommendedSongs
 
-    def getAuthtoken(self, client_id: str, client_secret: str) -> str:
-        if (VERBOSE): print("GENERATING AUTH TOKEN")
-        response = requests.post("https://accounts.spotify.com/api/token", data={"grant_type": "client_credentials", "client_id": client_id, "client_secret": client_secret})
-        return "Bearer " + response.json()["access_token"]
+    def getLocalRecommendations(self, model: AudioModel, exclude: list[Track], limit: int) -> list[Track]:
+        if (VERBOSE): print("GENERATING LOCAL RECOMMENDATIONS")
+        index = self.getLocalIndex()
+        if index is None:
+            return []
+        ids = index.query(model.getNumpyVector(), limit, {track.track_info.id for track in exclude})
+        tracks = self.trackStore.getMany(ids)
+        return [Track.fromData(tracks[id]) for id in ids if id in tracks]
+
+    def getLocalIndex(self) -> FeatureIndex:
+        with self.localIndexLock:
+            if self.localIndex is None or time.time() - self.localIndexBuilt > INDEX_TTL:
+                self.localIndex = self.buildLocalIndex()
+                self.localIndexBuilt = time.time()
+            return self.localIndex
+
+    def buildLocalIndex(self) -> FeatureIndex:
+        if (VERBOSE): print("BUILDING LOCAL INDEX")
+        # Stores only, this also serves as the fallback while the API is unreachable
+        known = self.trackStore.getIds()
+        features = {id: feature for id, feature in self.featureStore.getAll().items() if id in known}
+        if not features:
+            return None
+        matrix = np.array([[feature[field] for field in MODEL_FIELDS] for feature in features.values()], dtype=np.float64)
+        return FeatureIndex(list(features), matrix, self.getMetric())
+
+    def dedupe(self, tracks: list[Track], seeds: list[Track]) -> list[Track]:
+        # Drops tracks sharing any dedupe key with a seed or an earlier track
+        seen = set()
+        for track in seeds:
+            seen.update(track.genDedupeKeys())
+        unique = []
+        for track in tracks:
+            keys = track.genDedupeKeys()
+            if seen.isdisjoint(keys):
+                unique.append(track)
+            seen.update(keys)
+        return unique
+
+    def getSession(self) -> requests.Session:
+        with self.sessionLock:
+            if self.session is None:
+                self.session = configureSession(requests.Session(), self.poolSize)
+            return self.session
+
+    def getMetric(self) -> Metric:
+        # A metric that needs statistics is fitted once on every feature vector in the store,
+        # which already holds the current request's seeds by the time seeds are selected
+        with self.metricLock:
+            if self.metric is None:
+                self.metric = Metric()
+            if self.metric.needsFit() and not self.metric.fitted:
+                features = self.featureStore.getAll().values()
+                if len(features) > 1:
+                    self.metric.fit(np.array([[feature[field] for field in MODEL_FIELDS] for feature in features], dtype=np.float64))
+            return self.metric
+
+    def get(self, url: str, params: dict):
+        headers = {"Content-Type": "application/json", "Accept": "application/json"}
+        endpoint = url.rsplit("/", 1)[-1]
+        for attempt in range(MAX_RETRIES + 1):
+            auth = self.tokenManager.get(self.tracer)
+            # Take a token before sending so the bucket gates this request, cached lookups never get here
+            self.rateLimiter.acquire()
+            with self.metrics.timer("request_seconds", endpoint=endpoint):
+                response = self.getSession().get(url, headers={**headers, "Authorization": auth}, params=params)
+            self.metrics.increment("requests_total", endpoint=endpoint, status=response.status_code)
+            self.metrics.increment("response_bytes_total", len(response.content), endpoint=endpoint)
+            if attempt:
+                self.metrics.increment("retries_total", endpoint=endpoint)
+            span = self.tracer.current()
+            span.set_attribute("http.status_code", response.status_code)
+            span.set_attribute("retries", attempt)
+            span.set_attribute("response.bytes", len(response.content))
+            if response.status_code == 401:
+                if (VERBOSE): print("REFRESHING EXPIRED AUTH TOKEN")
+                self.tokenManager.invalidate(auth)
+                continue
+            if response.status_code != 429 and response.status_code < 500:
+                break
+            if (VERBOSE): print("RETRYING " + url + " AFTER " + str(response.status_code))
+            delay = self.rateLimiter.backoff(attempt)
+            if response.status_code == 429:
+                try:
+                    delay += float(response.headers.get("Retry-After"))
+                except (TypeError, ValueError):
+                    pass
+            self.rateLimiter.pause(delay)
+        response.raise_for_status()
+        return response
+
+    def getJson(self, url: str, params: dict, cache: bool = False, trim=None) -> dict:
+        # Decode each response body exactly once with the fastest decoder available.
+        # trim reduces the document to the fields the builder reads before it is cached.
+        # Searches and audio features have their own stores, so only recommendations use cache.
+        key = url + "?" + urlencode(sorted(params.items()))
+        if cache:
+            data = self.responseCache.get(key)
+            self.metrics.increment("cache_requests_total", cache="responses", result="miss" if data is None else "hit")
+            self.tracer.current().set_attribute("cache.hit", data is not None)
+            if data is not None:
+                return data
+        data = loads(self.get(url, params).content)
+        if trim:
+            data = trim(data)
+        if cache:
+            self.responseCache.put(key, data)
+        return data
+
+    def searchTracks(self, tracks: list[Track]) -> list[Track]:
+        # executor.map keeps results in input order
+        tracks = list(self.executor.map(self.searchTrack, tracks))
+        self.trackStore.putMany({track.track_info.id: track.toData() for track in tracks if track})
+        return tracks
 
     def searchTrack(self, track: Track):
-        if (VERBOSE): print("SEARCHING FOR TRACK: " + track.track_info.name)
-        q = track.track_info.genQuery()
-        response = self.session.get(
-            "https://api.spotify.com/v1/search",
-            headers={"Authorization": self.auth, "Content-Type": "application/json", "Accept": "application/json"}, 
-            params={"q": q, "type": "track", "limit": 1}
-        )
-        if not response.from_cache:
-            time.sleep(SLEEP_TIME)
-        if len(response.json()["tracks"]["items"]) == 0:
-            return
-        track = response.json()["tracks"]["items"][0]
+        key = track.track_info.genKey()
+        with self.tracer.span("spotify.search", query=key) as span:
+            data = self.searchCache.get(key)
+            self.metrics.increment("cache_requests_total", cache="search", result="miss" if data is None else "hit")
+            span.set_attribute("cache.hit", data is not None)
+            if data is not None:
+                return Track.fromData(data) if data else None
+            if (VERBOSE): print("SEARCHING FOR TRACK: " + track.track_info.name)
+            q = track.track_info.genQuery()
+            items = self.getJson("https://api.spotify.com/v1/search", params={"q": q, "type": "track", "limit": 1})["tracks"]["items"]
+            if len(items) == 0:
+                self.searchCache.put(key, {})
+                return
+            track = self.parseTrack(items[0])
+            self.searchCache.put(key, track.toData())
+            return track
+
+    def parseTrack(self, track: dict) -> Track:
         data = {
             "name": track["name"],
             "artist": track["artists"][0]["name"],
@@ -112,36 +1098,47 @@ class PlaylistBuilder:
             "id": track["id"],
             "href": track["href"]
         }
-        track = Track(track_info=TrackInfo(**data))
-        return track
+        return Track(track_info=TrackInfo(**data), isrc=track.get("external_ids", {}).get("isrc"))
 
-    def getAudioFeatures(self, tracks: list[Track]):
+    def getAudioFeatures(self, tracks: list[Track]) -> TrackCollection:
         if (VERBOSE): print("GETTING AUDIO FEATURES")
-        ids = [track.track_info.id for track in tracks]
-        response = self.session.get(
-            "https://api.spotify.com/v1/audio-features",
-            headers={"Authorization": self.auth, "Content-Type": "application/json", "Accept": "application/json"},
-            params={"ids": ",".join(ids)}
-        )
-        if not response.from_cache:
-            time.sleep(SLEEP_TIME)
-        features = response.json()["audio_features"]
-        for track, feature in zip(tracks, features):
+        ids = list(dict.fromkeys(track.track_info.id for track in tracks))
+        features = self.featureStore.getMany(ids)
+        missing = [id for id in ids if id not in features]
+        self.metrics.increment("cache_requests_total", len(features), cache="audio_features", result="hit")
+        self.metrics.increment("cache_requests_total", len(missing), cache="audio_features", result="miss")
+        chunks = [missing[i:i + AUDIO_FEATURES_CHUNK] for i in range(0, len(missing), AUDIO_FEATURES_CHUNK)]
+        fetched = {}
+        for chunk in self.executor.map(self.getAudioFeaturesChunk, chunks):
+            fetched.update(chunk)
+        self.featureStore.putMany(fetched)
+        features.update(fetched)
+        # Tracks without features (null entries) can't be modelled
+        tracks = [track for track in tracks if features.get(track.track_info.id)]
+        matrix = np.empty((len(tracks), len(MODEL_FIELDS)), dtype=np.float64)
+        for i, track in enumerate(tracks):
+            feature = features[track.track_info.id]
             track.audio_features = AudioFeatures(**feature)
-        return tracks
+            matrix[i] = [feature[field] for field in MODEL_FIELDS]
+        return TrackCollection(tracks, matrix)
+
+    def getAudioFeaturesChunk(self, ids: list[str]) -> dict:
+        with self.tracer.span("spotify.audio_features", ids=len(ids)):
+            features = self.getJson("https://api.spotify.com/v1/audio-features", params={"ids": ",".join(ids)})["audio_features"]
+        return {feature["id"]: feature for feature in features if feature}
 
-    def genAverageModel(self, tracks: list[Track]) -> AudioModel:
+    def genAverageModel(self, tracks: TrackCollection) -> AudioModel:
         if (VERBOSE): print("GENERATING AVERAGE MODEL")
-        mat = np.matrix([track.audio_features.model.getNumpyVector() for track in tracks])
-        return AudioModel(*mat.mean(axis=0).tolist()[0])
+        if not isinstance(tracks, TrackCollection):
+            tracks = TrackCollection(tracks)
+        return AudioModel(*tracks.matrix.mean(axis=0).tolist())
 
-    def getBestSeeds(self,tracks: list[Track], model: AudioModel, limit: int = 5) -> list[Track]:
+    def getBestSeeds(self, tracks: TrackCollection, model: AudioModel, limit: int = 5, diversity: float = None) -> list[Track]:
         if (VERBOSE): print("GETTING BEST SEEDS")
-        # if len(tracks) <= limit:
-        #     return tracks
-        mat = np.matrix([track.audio_features.model.getNumpyVector() for track in tracks])
-        dist = np.linalg.norm(mat - model.getNumpyVector(), axis=1)
-        return [tracks[i] for i in dist.argsort()[:limit]]
+        if not isinstance(tracks, TrackCollection):
+            tracks = TrackCollection(tracks)
+        diversity = self.seedDiversity if diversity is None else diversity
+        return [tracks[i] for i in selectSeeds(tracks.matrix, model.getNumpyVector(), self.getMetric(), limit, diversity)]
 
     def getModelRecommendations(self, model: AudioModel, seed_tracks: list[Track], limit: int = 10, cache: bool = True):
         if (VERBOSE): print("GENERATING RECOMMENDATIONS")
@@ -159,62 +1156,196 @@ class PlaylistBuilder:
                     "target_valence": model.valence,
                     "target_loudness": model.loudness
                 }
-        if cache:
-            response = self.session.get(
-                "https://api.spotify.com/v1/recommendations",
-                headers={"Authorization": self.auth, "Content-Type": "application/json", "Accept": "application/json"},
-                params=params
-            )
-        else:
-            with self.session.cache_disabled():
-                response = self.session.get(
-                    "https://api.spotify.com/v1/recommendations",
-                    headers={"Authorization": self.auth, "Content-Type": "application/json", "Accept": "application/json"},
-                    params=params
-                )
-        if not response.from_cache:
-            time.sleep(SLEEP_TIME)
-        tracks = []
-        for track in response.json()["tracks"]:
-            data = {
-                "name": track["name"],
-                "artist": track["artists"][0]["name"],
-                "album": track["album"]["name"],
-                "year": track["album"]["release_date"][:4],
-                "id": track["id"],
-                "href": track["href"]
-            }
-            track = Track(track_info=TrackInfo(**data))
-            tracks.append(track)
+        trim = lambda data: {"tracks": [trimTrack(track) for track in data["tracks"]]}
+        with self.tracer.span("spotify.recommendations", limit=limit, seeds=len(ids)):
+            tracks = self.getJson("https://api.spotify.com/v1/recommendations", params=params, cache=cache, trim=trim)["tracks"]
+        tracks = [self.parseTrack(track) for track in tracks]
+        self.trackStore.putMany({track.track_info.id: track.toData() for track in tracks})
+        self.storeFeatures([track.track_info.id for track in tracks])
         return tracks
 
+    def storeFeatures(self, ids: list[str]) -> None:
+        # Fetches features of newly recommended tracks so the local index can suggest them later.
+        # Runs on the executor inside recommend(), so chunks are fetched inline rather than submitted to it.
+        stored = self.featureStore.getMany(ids)
+        missing = [id for id in dict.fromkeys(ids) if id not in stored]
+        try:
+            for i in range(0, len(missing), AUDIO_FEATURES_CHUNK):
+                self.featureStore.putMany(self.getAudioFeaturesChunk(missing[i:i + AUDIO_FEATURES_CHUNK]))
+        except requests.RequestException as e:
+            # The recommendations themselves succeeded, only the local index misses out
+            if (VERBOSE): print("STORING RECOMMENDED FEATURES FAILED: " + str(e))
+            self.metrics.increment("feature_store_failures_total")
 
-if __name__ == "__main__":
-    CLIENT_ID = os.environ.get("CLIENT_ID")
-    CLIENT_SECRET = os.environ.get("CLIENT_SECRET")
-    SLEEP_TIME = 0.1
-
-    data = " ".join(sys.argv[1:])
-    data = json.loads(data)
 
+def parseRequest(data: dict) -> tuple[list[Track], int]:
     tracks = [Track(track_info=TrackInfo(**track)) for track in data["tracks"]]
-    # TODO: Cache token
-
-    playlistBuilder = PlaylistBuilder(CLIENT_ID, CLIENT_SECRET, tracks)
-
-    playlist = playlistBuilder.run(data["limit"])
+    return tracks, int(data["limit"])
 
-    playlist = [track.track_info.__dict__ for track in playlist]
+def parseCache(data: dict) -> bool:
+    # "cache": false in a request skips the playlist cache, leaving it out uses the builder default
+    return None if data.get("cache") is None else bool(data["cache"])
 
-    playlist = {
+def formatPlaylist(playlist: list[Track]) -> dict:
+    playlist = [track.track_info.toDict() for track in playlist]
+    return {
         "tracks": playlist,
     }
 
-    print(json.dumps(playlist))
+def buildPlaylist(playlistBuilder: PlaylistBuilder, data: dict) -> dict:
+    tracks, limit = parseRequest(data)
+    return formatPlaylist(playlistBuilder.run(limit, tracks, parseCache(data)))
+
+def buildLine(playlistBuilder: PlaylistBuilder, line: str) -> dict:
+    # Results echo the request's "id" since streamed playlists can finish out of order
+    data = {}
+    try:
+        data = json.loads(line)
+        result = buildPlaylist(playlistBuilder, data)
+    except KeyError as e:
+        result = {"error": "Missing field: " + str(e)}
+    except Exception as e:
+        result = {"error": str(e)}
+    if isinstance(data, dict) and "id" in data:
+        result = {"id": data["id"], **result}
+    return result
+
+def streamPlaylists(playlistBuilder: PlaylistBuilder, lines, out, jobs: int = MAX_WORKERS) -> None:
+    # One playlist request per line in, one JSON result per line out as each one finishes
+    def write(futures) -> None:
+        for future in futures:
+            out.write(json.dumps(future.result()) + "\n")
+        out.flush()
+
+    with ThreadPoolExecutor(max_workers=jobs) as executor:
+        pending = set()
+        for line in lines:
+            if not line.strip():
+                continue
+            pending.add(executor.submit(buildLine, playlistBuilder, line))
+            # Bound how much of the input is read ahead of the results
+            if len(pending) >= jobs * 2:
+                done, pending = wait(pending, return_when=FIRST_COMPLETED)
+                write(done)
+        while pending:
+            done, pending = wait(pending, return_when=FIRST_COMPLETED)
+            write(done)
+
+workerBuilder = None
+
+def initWorker(client_id: str, client_secret: str, rate_limiter: RateLimiter, cache_playlists: bool) -> None:
+    global workerBuilder
+    workerBuilder = PlaylistBuilder(client_id, client_secret, rate_limiter=rate_limiter, cache_playlists=cache_playlists)
+
+def buildWorkerLine(line: str) -> tuple[dict, Metrics]:
+    # Each line gets fresh metrics so the parent can add them up without double counting
+    workerBuilder.metrics = Metrics()
+    return buildLine(workerBuilder, line), workerBuilder.metrics
+
+def runWorkers(client_id: str, client_secret: str, lines, out, workers: int, cache_playlists: bool = True, metrics: Metrics = None) -> None:
+    # Shards requests over processes that each keep their own builder and session. The single store
+    # file, responses included, is shared through SQLite WAL locking, the request budget through SharedRateLimiter.
+    rateLimiter = SharedRateLimiter()
+    with multiprocessing.Pool(workers, initializer=initWorker, initargs=(client_id, client_secret, rateLimiter, cache_playlists)) as pool:
+        for result, workerMetrics in pool.imap_unordered(buildWorkerLine, (line for line in lines if line.strip())):
+            out.write(json.dumps(result) + "\n")
+            out.flush()
+            if metrics is not None:
+                metrics.merge(workerMetrics)
+
+class PlaylistHandler:
+    # Request handler mixin, serve() combines it with http.server's BaseHTTPRequestHandler.
+    # POST the same {"tracks": [...], "limit": n} payload the CLI takes
+    playlistBuilder: PlaylistBuilder = None
+
+    def do_GET(self) -> None:
+        if self.path.split("?")[0] != "/metrics":
+            return self.respond(404, {"error": "Not found"})
+        if "format=json" in self.path:
+            return self.respond(200, self.playlistBuilder.metrics.toJson())
+        body = self.playlistBuilder.metrics.toPrometheus().encode()
+        self.send_response(200)
+        self.send_header("Content-Type", "text/plain; version=0.0.4")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def do_POST(self) -> None:
+        try:
+            data = json.loads(self.rfile.read(int(self.headers.get("Content-Length", 0))))
+            tracks, limit = parseRequest(data)
+            cache = parseCache(data)
+        except (ValueError, KeyError, TypeError) as e:
+            return self.respond(400, {"error": "Invalid playlist request: " + str(e)})
+        try:
+            playlist = self.playlistBuilder.run(limit, tracks, cache)
+        except Exception as e:
+            return self.respond(500, {"error": str(e)})
+        self.respond(200, formatPlaylist(playlist))
+
+    def respond(self, status: int, body: dict) -> None:
+        body = json.dumps(body).encode()
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format: str, *args) -> None:
+        if (VERBOSE): super().log_message(format, *args)
+
+def serve(playlistBuilder: PlaylistBuilder, host: str, port: int) -> None:
+    from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+    handler = type("Handler", (PlaylistHandler, BaseHTTPRequestHandler), {"playlistBuilder": playlistBuilder})
+    server = ThreadingHTTPServer((host, port), handler)
+    if (VERBOSE): print("SERVING ON " + host + ":" + str(port))
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+
+if __name__ == "__main__":
+    CLIENT_ID = os.environ.get("CLIENT_ID")
+    CLIENT_SECRET = os.environ.get("CLIENT_SECRET")
+
+    parser = argparse.ArgumentParser(description="Build a playlist from seed tracks")
+    # REMAINDER keeps words of an unquoted payload that start with "-" (a "Song -Live" title) out of option parsing
+    parser.add_argument("payload", nargs=argparse.REMAINDER, help='playlist request, {"tracks": [...], "limit": n}, after any options')
+    parser.add_argument("--serve", type=int, metavar="PORT", help="keep a warm builder and serve POST requests on PORT")
+    parser.add_argument("--host", default="127.0.0.1", help="address to bind with --serve")
+    parser.add_argument("--jsonl", nargs="?", const="-", metavar="FILE", help="read one playlist request per line from FILE (default stdin) and stream one result per line")
+    parser.add_argument("--jobs", type=int, default=MAX_WORKERS, help="playlists built at once with --jsonl")
+    parser.add_argument("--workers", type=int, help="shard --jsonl requests over this many processes")
+    parser.add_argument("--metrics", metavar="FILE", help="write stage and request metrics to FILE when done, as JSON if it ends in .json and Prometheus text otherwise")
+    parser.add_argument("--no-cache", action="store_true", help="rebuild playlists instead of returning cached results, the fresh results are still cached")
+    args = parser.parse_args()
+
+    if args.jsonl and args.workers:
+        metrics = Metrics()
+        with (sys.stdin if args.jsonl == "-" else open(args.jsonl)) as lines:
+            runWorkers(CLIENT_ID, CLIENT_SECRET, lines, sys.stdout, args.workers, not args.no_cache, metrics)
+    else:
+        playlistBuilder = PlaylistBuilder(CLIENT_ID, CLIENT_SECRET, cache_playlists=not args.no_cache)
+        metrics = playlistBuilder.metrics
+
+        if args.serve:
+            serve(playlistBuilder, args.host, args.serve)
+        elif args.jsonl:
+            with (sys.stdin if args.jsonl == "-" else open(args.jsonl)) as lines:
+                streamPlaylists(playlistBuilder, lines, sys.stdout, args.jobs)
+        else:
+            data = json.loads(" ".join(args.payload))
+            print(json.dumps(buildPlaylist(playlistBuilder, data)))
 
-    
+    if args.metrics:
+        with open(args.metrics, "w") as f:
+            if args.metrics.endswith(".json"):
+                json.dump(metrics.toJson(), f)
+            else:
+                f.write(metrics.toPrometheus())
 
-    # TODO: Fix inserting repeated tracks
 
 # WITH TARGETS
 # クラウディ Simon & Garfunkel
@@ -1,3 +1,3 @@
 cd ~/Code/Python/playlistBuilder
 source env/bin/activate
-python playlistBuilder.py $1
\ No newline at end of file
+python playlistBuilder.py "$@"
\ No newline at end of file
@@ -0,0 +1,57 @@
+import os
+import multiprocessing
+import tempfile
+import unittest
+from benchmark import MockSpotifyAdapter
+from playlistBuilder import MAX_WORKERS, PlaylistBuilder, RateLimiter, TokenManager, Track, TrackInfo
+
+TIMEOUT = 30 # seconds before a build is considered deadlocked
+
+class NestedExecutorTest(unittest.TestCase):
+    # recommend() runs on the builder's executor, anything it calls must not submit to that executor again
+    def setUp(self) -> None:
+        self.cwd = os.getcwd()
+        self.directory = tempfile.TemporaryDirectory()
+        os.chdir(self.directory.name)
+        self.adapter = MockSpotifyAdapter(latency=0)
+        self.tokenManager = TokenManager("test", "test")
+        self.tokenManager.getSession().mount("https://", self.adapter)
+
+    def tearDown(self) -> None:
+        os.chdir(self.cwd)
+        self.directory.cleanup()
+
+    def builder(self, **kwargs) -> PlaylistBuilder:
+        builder = PlaylistBuilder("test", "test", rate_limiter=RateLimiter(1000, 1000), token_manager=self.tokenManager, cache_playlists=False, **kwargs)
+        builder.getSession().mount("https://", self.adapter)
+        return builder
+
+    def seeds(self, start: int, count: int) -> list[Track]:
+        return [Track(track_info=TrackInfo(name="Seed " + str(i), artist="Artist " + str(i))) for i in range(start, start + count)]
+
+    def finish(self, fn):
+        # Runs fn in a forked process so a deadlocked executor can be killed instead of hanging the run
+        context = multiprocessing.get_context("fork")
+        queue = context.Queue()
+        process = context.Process(target=lambda: queue.put(fn()))
+        process.start()
+        process.join(TIMEOUT)
+        if process.is_alive():
+            process.kill()
+            self.fail("build deadlocked")
+        return queue.get(timeout=TIMEOUT)
+
+    def testLocalSingleWorker(self) -> None:
+        self.builder().run(10, self.seeds(0, 10))
+        size = self.finish(lambda: len(self.builder(max_workers=1, recommender="local").run(10, self.seeds(10, 10))))
+        self.assertEqual(size, 10)
+
+    def testBlendBatchPastPoolSize(self) -> None:
+        self.builder().run(10, self.seeds(0, 10))
+        builder = self.builder(recommender="blend")
+        jobs = [(self.seeds(10 + 5 * i, 5), 5) for i in range(MAX_WORKERS + 2)]
+        sizes = self.finish(lambda: [len(playlist) for playlist in builder.runBatch(jobs)])
+        self.assertEqual(sizes, [5] * len(jobs))
+
+if __name__ == "__main__":
+    unittest.main()